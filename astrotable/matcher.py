@@ -8,12 +8,265 @@ Built-in matchers.
 """
 
 import numpy as np
-from astrotable.utils import find_idx, find_eq, find_dup
-from astropy.coordinates import SkyCoord
+from astrotable.utils import find_dup, objdict, SENTINEL
+from astropy.coordinates import SkyCoord, Angle
 import astropy.units as u
 from astropy.units import UnitTypeError
+from scipy.spatial import cKDTree
 import warnings
 from collections.abc import Iterable
+from functools import lru_cache
+import weakref
+import hashlib
+try:
+    import pandas as pd # used for hash joins in ExactMatcher
+except ImportError:
+    has_pd = False
+else:
+    has_pd = True
+
+_RAD_TO_ARCSEC = u.rad.to(u.arcsec)
+_QUERY_CHUNK_SIZE = 65536 # number of points in each KD-tree query
+
+def _radec_to_xyz(ra, dec):
+    '''
+    Convert RA, Dec (in rad) to Cartesian coordinates on the unit sphere.
+    Returns array of shape (N, 3).
+    '''
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec*np.cos(ra), cos_dec*np.sin(ra), np.sin(dec)])
+
+def _haversine(ra1, dec1, ra2, dec2):
+    '''
+    Angular separation (in rad) between (ra1, dec1) and (ra2, dec2), all in rad.
+    '''
+    a = np.sin(0.5*(dec2-dec1))**2 + np.cos(dec1)*np.cos(dec2)*np.sin(0.5*(ra2-ra1))**2
+    return 2*np.arcsin(np.sqrt(a))
+
+@lru_cache(maxsize=None)
+def _get_haversine_arcsec():
+    '''
+    Get the Numba kernel ``_haversine_arcsec(ra1, dec1, ra2, dec2, idx, out)``, 
+    same as ``_haversine(ra1, dec1, ra2[idx], dec2[idx])`` but in arcsec.
+    Returns None if numba is not installed. numba is only imported when this is first called.
+    '''
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+    
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _haversine_arcsec(ra1, dec1, ra2, dec2, idx, out):
+        # in one pass without temporary arrays (ra2, dec2 are gathered here instead of with ra2[idx], dec2[idx])
+        for i in prange(ra1.shape[0]):
+            j = idx[i]
+            a = np.sin(0.5*(dec2[j]-dec1[i]))**2 + np.cos(dec1[i])*np.cos(dec2[j])*np.sin(0.5*(ra2[j]-ra1[i]))**2
+            a = min(a, 1.0) # fastmath may give a slightly > 1 for near-antipodal pairs
+            out[i] = 2*np.arcsin(np.sqrt(a)) * _RAD_TO_ARCSEC
+        return out
+    
+    return _haversine_arcsec
+
+def _sep_arcsec(ra1, dec1, ra2, dec2, idx):
+    '''
+    Angular separation (in arcsec) between (ra1, dec1) and (ra2[idx], dec2[idx]), all in rad.
+    '''
+    haversine_arcsec = _get_haversine_arcsec()
+    if haversine_arcsec is not None:
+        return haversine_arcsec(ra1, dec1, ra2, dec2, idx, np.empty(ra1.shape, dtype=np.float64))
+    else:
+        return _haversine(ra1, dec1, ra2[idx], dec2[idx]) * _RAD_TO_ARCSEC
+
+def _split_unit(unit):
+    '''
+    Split the ``unit`` argument of SkyMatcher into units for RA and Dec,
+    following the convention of ``astropy.coordinates.SkyCoord``.
+    '''
+    if isinstance(unit, str) and ',' in unit:
+        unit = unit.split(',')
+    if isinstance(unit, (list, tuple, np.ndarray)):
+        if len(unit) != 2:
+            raise ValueError(f'expected 2 units for RA and Dec, got {len(unit)}')
+        return tuple(unit)
+    return unit, unit
+
+def _col_to_rad(col, unit, missing=None):
+    '''
+    Convert a column (or array) to a contiguous float64 array in rad,
+    only keeping the rows that are not ``missing``.
+    The unit of the column (if any) is used; otherwise ``unit`` is used.
+    Non-numeric columns (e.g. sexagesimal strings like '10:00:00') are parsed with ``astropy.coordinates.Angle``.
+    '''
+    if getattr(col, 'unit', None) is not None:
+        unit = col.unit
+    if unit is not None:
+        try:
+            unit = u.Unit(unit)
+        except (ValueError, TypeError) as e:
+            raise UnitTypeError(f"expected units equivalent to 'rad', got {unit}") from e
+        if not unit.is_equivalent(u.rad):
+            raise UnitTypeError(f"expected units equivalent to 'rad', got {unit}")
+    arr = np.asarray(col) # plain ndarray (data of masked columns; the mask is given by ``missing``)
+    if missing is not None:
+        arr = arr[~missing]
+    if arr.dtype.kind in 'biuf':
+        if unit is None:
+            raise UnitTypeError("no unit given for numeric coordinates")
+        return np.ascontiguousarray(arr.astype(np.float64, copy=False) * unit.to(u.rad))
+    else:
+        return np.ascontiguousarray(Angle(arr, unit=unit).rad, dtype=np.float64)
+
+def _join_first(array, values):
+    '''
+    Find the index of the first element in ``array`` equal to each of ``values``.
+    Both are factorized into integer codes at once (``np.unique(..., return_inverse=True)``),
+    and the codes of ``values`` are looked up in a table indexed by code.
+    
+    Returns ``idx, found``, like ``astrotable.utils.find_idx``; ``idx`` is 0 where not found.
+    '''
+    n = len(values)
+    codes = np.unique(np.concatenate([values, array]), return_inverse=True)[1].ravel()
+    codes_v, codes_a = codes[:n], codes[n:]
+    lookup = np.full(codes.max()+1 if codes.size > 0 else 0, -1, dtype=np.intp)
+    uniq_codes_a, first_idx = np.unique(codes_a, return_index=True) # the first element in array for each code
+    lookup[uniq_codes_a] = first_idx
+    idx = lookup[codes_v]
+    found = idx >= 0
+    if values.dtype.kind in 'fc': # NaN is not equal to NaN (but np.unique puts them in one code)
+        found &= ~np.isnan(values)
+    idx = np.where(found, idx, 0)
+    return idx, found
+
+@lru_cache(maxsize=None)
+def _get_join_first_int64():
+    '''
+    Get the Numba kernel ``_join_first_int64(array, values)``, same as ``_join_first`` for int64 keys.
+    Returns None if numba is not installed. 
+    numba is only imported (and the kernel compiled) when this is first called, since it is only used without pandas.
+    '''
+    try:
+        from numba import njit, types
+        from numba.typed import Dict
+    except ImportError:
+        return None
+    
+    @njit(cache=True)
+    def _join_first_int64(array, values):
+        # build a hash table of array and probe it with values in one call
+        first_idx = Dict.empty(key_type=types.int64, value_type=types.int64)
+        for i in range(array.shape[0]):
+            if array[i] not in first_idx:
+                first_idx[array[i]] = i
+        idx = np.zeros(values.shape[0], dtype=np.intp)
+        found = np.zeros(values.shape[0], dtype=np.bool_)
+        for i in range(values.shape[0]):
+            if values[i] in first_idx:
+                idx[i] = first_idx[values[i]]
+                found[i] = True
+        return idx, found
+    
+    return _join_first_int64
+
+def _fits_int64(dtype):
+    return dtype.kind == 'i' or (dtype.kind == 'u' and dtype.itemsize < 8)
+
+def _join_first_hash(array, values):
+    '''
+    Same as ``_join_first``, but with a hash join (``pandas.Index.get_indexer``).
+    '''
+    index = pd.Index(np.asarray(array))
+    first_idx = None
+    if not index.is_unique: # get_indexer needs unique values; keep the first of each value
+        first_idx = np.flatnonzero(~index.duplicated(keep='first'))
+        index = index[first_idx]
+    idx = index.get_indexer(np.asarray(values))
+    found = idx >= 0
+    if first_idx is not None:
+        idx = first_idx[idx]
+    idx = np.where(found, idx, 0)
+    return idx, found
+
+def _has_dup_coord(ra, dec):
+    _, counts = np.unique(np.stack([ra, dec]), axis=1, return_counts=True)
+    return bool(np.any(counts != 1))
+
+# cached values prepared by SkyMatcher.get_values for each Data object: {data: {(ra_name, dec_name): objdict}}.
+# This is kept outside of the Data objects, so that it is not pickled with them (see ``Data.save``),
+# and it is freed when the Data object is deleted.
+_sky_cache = weakref.WeakKeyDictionary()
+
+def _sky_fingerprint(ra, dec, units):
+    '''
+    A hash of the values, masks and units of columns ``ra``, ``dec`` (and the input ``units``),
+    so that any change to the columns (including in-place modification) invalidates the cache.
+    Returns None if the columns cannot be hashed (e.g. object dtype), in which case nothing is cached.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((str(getattr(ra, 'unit', None)), str(getattr(dec, 'unit', None)), tuple(map(str, units)))).encode())
+    for col in [ra, dec]:
+        arr = np.asarray(col)
+        if arr.dtype.hasobject:
+            return None
+        h.update(repr((arr.dtype.str, arr.shape)).encode())
+        h.update(np.ascontiguousarray(arr))
+        mask = np.ma.getmask(col)
+        h.update(np.ascontiguousarray(mask) if mask is not np.ma.nomask else b'nomask')
+    return h.digest()
+
+def _get_sky_cache(datai, ra_name, dec_name, fingerprint):
+    '''
+    Get the cached values (prepared by ``SkyMatcher.get_values``) for columns ``ra_name``, ``dec_name`` of ``datai``,
+    so that they are only computed once when one catalog is matched to/with many others.
+    Returns None if not cached, or if the columns have changed since caching.
+    '''
+    if fingerprint is None:
+        return None
+    cache = _sky_cache.get(datai, {}).get((ra_name, dec_name))
+    if cache is None or cache.fingerprint != fingerprint:
+        return None
+    return cache.result
+
+def _set_sky_cache(datai, ra_name, dec_name, fingerprint, values):
+    if fingerprint is not None:
+        _sky_cache.setdefault(datai, {})[(ra_name, dec_name)] = objdict(
+            fingerprint = fingerprint,
+            result = values,
+            )
+    return values
+
+def clear_sky_cache(data=None):
+    '''
+    Clear the coordinates cached by ``SkyMatcher`` for ``data`` (a ``astrotable.table.Data`` object),
+    or for all Data objects if ``data`` is None.
+    '''
+    if data is None:
+        _sky_cache.clear()
+    else:
+        _sky_cache.pop(data, None)
+
+def _fill_match(idx_nm, matched_nm, missing, not_missing_id1):
+    '''
+    Get ``idx, matched`` for all rows of the base data from the results for non-missing rows.
+    ``missing`` and ``not_missing_id1`` are None if nothing is missing.
+    Rows that are not matched get index ``SENTINEL``.
+    
+    ``idx`` is of dtype ``np.intp`` (the integer type used for indexing), 
+    and ``matched`` is of dtype ``bool`` (1 byte per row).
+    '''
+    if not_missing_id1 is not None and not_missing_id1.size > 0:
+        idx_nm = not_missing_id1[idx_nm]
+    idx_nm = np.where(matched_nm, idx_nm, SENTINEL).astype(np.intp, copy=False)
+    if missing is None: # nothing missing: results are already for all rows
+        return idx_nm, matched_nm
+    
+    # write the results of non-missing rows with np.place (one scan) rather than fancy indexing
+    nm = ~missing
+    idx = np.empty(missing.shape, dtype=np.intp)
+    np.copyto(idx, SENTINEL, where=missing)
+    np.place(idx, nm, idx_nm)
+    matched = np.zeros(missing.shape, dtype=bool)
+    np.place(matched, nm, matched_nm)
+    return idx, matched
 
 class UnsafeMatchingWarning(Warning):
     pass
@@ -42,82 +295,98 @@ class ExactMatcher():
             - Iterable, values for `data1`. `len(value1)` should be equal to `len(data1)`.
             
             If not given and ``value`` is a string, ``value1`` set to the same as ``value``.
+        
+        Notes
+        -----
+        If a value appears multiple times in ``value1``, the first row of ``data1``
+        with this value is matched.
         '''
         self.value = value
         self.value1 = value1
         
-        self.value_name, self.value1_name = f'"{value}"' if isinstance(value, str) else value, f'"{value1}"' if isinstance(value1, str) else value1 # before evaluation, let the input be the names
-        
         if self.value1 is None:
             if isinstance(self.value, str):
                 self.value1 = self.value
             else:
                 raise TypeError("argument missing: 'value1'")
-    
-    def get_values(self, data, data1, verbose=True):
-        valuetype, value1type = type(self.value), type(self.value1)
-        if isinstance(self.value, str):
-            self.value = data[self.value]
-        elif isinstance(self.value, Iterable):
-            if not isinstance(self.value, np.ndarray): # Column, MaskedArray, etc. are instances of np.ndarray but will be converted by np.array(), so we need this condition
-                self.value = np.array(self.value)
-        else:
-            raise TypeError(f"expected str or Iterable for 'value', got '{type(self.value)}'")
-        if isinstance(self.value1, str):
-            self.value1 = data1[self.value1]
-        elif isinstance(self.value1, Iterable):
-            if not isinstance(self.value1, np.ndarray): # Column, MaskedArray, etc. are instances of np.ndarray but will be converted by np.array(), so we need this condition
-                self.value1 = np.array(self.value1)
-        else:
-            raise TypeError(f"expected str or Iterable for 'value1', got '{type(self.value1)}'")
         
-        if hasattr(self.value, 'name'):
-            self.value_name = f'"{self.value.name}"'
+        # decide the type of input once: ('name', column name) or ('array', values)
+        self._value_source = self._get_source(self.value, 'value')
+        self._value1_source = self._get_source(self.value1, 'value1')
+        self.value_name, self.value1_name = self._get_name(self.value), self._get_name(self.value1)
+    
+    @staticmethod
+    def _get_source(value, argname):
+        if isinstance(value, str):
+            return 'name', value
+        elif isinstance(value, Iterable):
+            if not isinstance(value, np.ndarray): # Column, MaskedArray, etc. are instances of np.ndarray but will be converted by np.array(), so we need this condition
+                value = np.array(value)
+            return 'array', value
         else:
-            self.value_name = valuetype
-        if hasattr(self.value1, 'name'):
-            self.value1_name = f'"{self.value1.name}"'
+            raise TypeError(f"expected str or Iterable for '{argname}', got '{type(value)}'")
+    
+    @staticmethod
+    def _get_name(value):
+        if isinstance(value, str):
+            return f'"{value}"'
+        elif hasattr(value, 'name'):
+            return f'"{value.name}"'
         else:
-            self.value1_name = value1type
-            
-        dup_vals = find_dup(self.value)
-        if dup_vals.size > 0:
-            warnings.warn(f"Duplications found for data '{data.name}' while matching '{data1.name}' to it: the same row of '{data1.name}' may be matched to multiple rows in '{data.name}'.",
-                          stacklevel=3, category=DuplicationWarning)
-        dup_vals = find_dup(self.value1)
-        if dup_vals.size > 0:
-            warnings.warn(f"Duplications found for data '{data1.name}' while matching to '{data.name}': there may be multiple rows in '{data1.name}' that can be matched to a row in '{data.name}', and only one will be returned by the matcher.",
-                          stacklevel=3, category=DuplicationWarning)
-        missings = [] # whether the coord is missing
-        not_missing_ids = [] # the indices of those that are not missing
-        for valuei, datai in [[self.value, data], [self.value1, data1]]:
+            return type(value)
+    
+    def get_values(self, data, data1, verbose=True):
+        values = []
+        missings = [] # whether the value is missing (None if nothing is missing)
+        not_missing_ids = [] # the indices of those that are not missing (None if nothing is missing)
+        for (source, valuei), datai in [[self._value_source, data], [self._value1_source, data1]]:
+            if source == 'name':
+                valuei = datai[valuei]
             if np.ma.is_masked(valuei): #datai.t.masked:
                 # NOTE: it should not matter whether datai.t is masked; it is valuei that matters. A table that is not "masked" can have masked colums; valuei can also be user-specified rather than from datai.t
-                missingi = valuei.mask
+                missingi = np.asarray(valuei.mask)
+                not_missing_idi = np.flatnonzero(~missingi)
             else:
-                missingi = np.full(len(datai), False)
-            not_missing_idi = np.arange(len(datai), dtype=int)[~missingi]
+                missingi, not_missing_idi = None, None
+            values.append(np.asarray(valuei)) # plain ndarray (the mask is kept separately), so that no MaskedArray operations are needed
             missings.append(missingi)
             not_missing_ids.append(not_missing_idi)
         
+        self.value, self.value1 = values
         self.missing, self.missing1 = missings
         self.not_missing_id, self.not_missing_id1 = not_missing_ids
+            
+        dup_vals = find_dup(self.value if self.missing is None else self.value[~self.missing])
+        if dup_vals.size > 0:
+            warnings.warn(f"Duplications found for data '{data.name}' while matching '{data1.name}' to it: the same row of '{data1.name}' may be matched to multiple rows in '{data.name}'.",
+                          stacklevel=3, category=DuplicationWarning)
+        dup_vals = find_dup(self.value1 if self.missing1 is None else self.value1[~self.missing1])
+        if dup_vals.size > 0:
+            warnings.warn(f"Duplications found for data '{data1.name}' while matching to '{data.name}': there may be multiple rows in '{data1.name}' that can be matched to a row in '{data.name}', and only one will be returned by the matcher.",
+                          stacklevel=3, category=DuplicationWarning)
     
     def match(self):
-        l = len(self.missing)
-        idx = np.full(self.missing.shape, -l-1)
-        matched = np.full(self.missing.shape, False)
-        idx_nm, matched_nm = find_idx(self.value1[~self.missing1], self.value[~self.missing])
-        matched[~self.missing] = matched_nm
-        idx[matched] = self.not_missing_id1[idx_nm[matched_nm]]
-        return idx, matched
+        value = self.value if self.missing is None else self.value[~self.missing]
+        value1 = self.value1 if self.missing1 is None else self.value1[~self.missing1]
+        kinds = {value.dtype.kind, value1.dtype.kind}
+        join_first_int64 = None
+        if not has_pd and _fits_int64(value.dtype) and _fits_int64(value1.dtype):
+            join_first_int64 = _get_join_first_int64() # None if numba is not installed
+        
+        if has_pd and (kinds <= {'i', 'u'} or kinds <= {'U', 'O'}): # integer or string keys
+            idx_nm, matched_nm = _join_first_hash(value1, value)
+        elif join_first_int64 is not None:
+            idx_nm, matched_nm = join_first_int64(value1.astype(np.int64, copy=False), value.astype(np.int64, copy=False))
+        else:
+            idx_nm, matched_nm = _join_first(value1, value)
+        return _fill_match(idx_nm, matched_nm, self.missing, self.not_missing_id1)
     
     def __repr__(self):
         return f'ExactMatcher({self.value_name}, {self.value1_name})'
 
 
 class SkyMatcher():
-    def __init__(self, thres=1, coord=None, coord1=None, unit=u.deg, unit1=u.deg):
+    def __init__(self, thres=1, coord=None, coord1=None, unit=u.deg, unit1=u.deg, tree='kdtree'):
         '''
         Used to match `astrotable.table.Data` objects `data1` to `data`.
         Match records with nearest coordinates.
@@ -148,104 +417,199 @@ class SkyMatcher():
             If astropy.coordinates.SkyCoord object is not given for coord1, 
             this is used to specify the unit of coord1.
             The default is astropy.units.deg.
+        tree : str, optional
+            The tree used to search for neighbors. Possible inputs are:
+            - 'kdtree', ``scipy.spatial.cKDTree`` on the Cartesian coordinates on the unit sphere.
+            - 'balltree', ``sklearn.neighbors.BallTree`` with the haversine metric on (Dec, RA). 
+              This requires scikit-learn; if it is not installed, 'kdtree' is used.
+            The default is 'kdtree'.
            
         Notes
         -----
         The data columns for RA, Dec may already have units (e.g. ``data.t['RA'].unit``).
         In this case, any input for ``unit`` or ``unit1`` is ignored, and the units recorded
         in the columns are used.
+        
+        The coordinates prepared from the RA, Dec columns of a Data object are cached,
+        so that matching one catalog with many others only prepares them once. The cache is keyed
+        on a hash of the column values, masks and units, so changes to the columns (including in-place
+        modification) are detected. Use ``astrotable.matcher.clear_sky_cache()`` to free the memory.
         '''
         self.thres = thres
         self.coord = coord
         self.coord1 = coord1
         self.unit = unit
         self.unit1 = unit1
+        
+        if tree not in ('kdtree', 'balltree'):
+            raise ValueError(f"expected 'kdtree' or 'balltree' for 'tree', got '{tree}'")
+        if tree == 'balltree':
+            try:
+                import sklearn.neighbors
+            except ImportError:
+                warnings.warn("scikit-learn is not installed: tree='balltree' is not available, using tree='kdtree' instead.",
+                              stacklevel=2)
+                tree = 'kdtree'
+        self.tree = tree
+        
+        # decide the type of input once: ('auto', None), ('radec-str', (ra_name, dec_name)) or ('skycoord', coord)
+        self._coord_source = self._get_source(coord)
+        self._coord1_source = self._get_source(coord1)
+    
+    @staticmethod
+    def _get_source(coord):
+        if coord is None:
+            return 'auto', None
+        elif isinstance(coord, str):
+            ra_name, dec_name = coord.split('-')
+            return 'radec-str', (ra_name, dec_name)
+        elif type(coord) is SkyCoord:
+            return 'skycoord', coord
+        else:
+            raise TypeError(f"Unsupported type for coord/coord1: expected str or astropy.coordinates.SkyCoord, got {type(coord)}")
     
     def get_values(self, data, data1, verbose=True):
         # TODO: this method has not been debugged!
         # USE WITH CAUTION!
-        ra_names = np.array(['ra', 'RA'])
-        dec_names = np.array(['DEC', 'Dec', 'dec'])
-        coords = []
-        missings = [] # whether the coord is missing
-        not_missing_ids = [] # the indices of those that are not missing
-        for coordi, datai, uniti in [[self.coord, data, self.unit], [self.coord1, data1, self.unit1]]:
-            if coordi is None or isinstance(coordi, str):
-                if coordi is None: # auto decide ra, dec
-                    found_ra = np.isin(ra_names, datai.colnames)
-                    if not np.any(found_ra):
+        ra_names = ('ra', 'RA')
+        dec_names = ('DEC', 'Dec', 'dec')
+        radecs = []
+        xyzs = []
+        has_dups = []
+        missings = [] # whether the coord is missing (None if nothing is missing)
+        not_missing_ids = [] # the indices of those that are not missing (None if nothing is missing)
+        for (source, coordi), datai, uniti in [[self._coord_source, data, self.unit], [self._coord1_source, data1, self.unit1]]:
+            if source in ('auto', 'radec-str'):
+                if source == 'auto': # auto decide ra, dec
+                    colnames = set(datai.colnames)
+                    self.ra_name = next((name for name in ra_names if name in colnames), None)
+                    if self.ra_name is None:
                         raise KeyError(f'RA for {datai.name} not found.')
-                    self.ra_name = ra_names[np.where(found_ra)][0]
                     ra = datai.t[self.ra_name]
     
-                    found_dec = np.isin(dec_names, datai.colnames)
-                    if not np.any(found_dec):
+                    self.dec_name = next((name for name in dec_names if name in colnames), None)
+                    if self.dec_name is None:
                         raise KeyError(f'Dec for {datai.name} not found.')
-                    self.dec_name = dec_names[np.where(found_dec)][0]
                     dec = datai.t[self.dec_name]
                     
                     if verbose: print(f"[SkyMatcher] Data {datai.name}: found RA name '{self.ra_name}' and Dec name '{self.dec_name}'.")
             
-                else: # type(coordi) is str:
-                    self.ra_name, self.dec_name = coordi.split('-')
+                else: # source == 'radec-str'
+                    self.ra_name, self.dec_name = coordi
                     ra = datai.t[self.ra_name]
                     dec = datai.t[self.dec_name]
                 
-                # check missing values for ra and dec
-                # TODO: below NOT TESTED
-                missingi = np.full(len(datai), False)
-                if np.ma.is_masked(ra):
-                    missingi |= ra.mask
-                if np.ma.is_masked(dec): # datai.t.masked or 
-                    missingi |= dec.mask
+                units = _split_unit(uniti)
+                fingerprint = _sky_fingerprint(ra, dec, units)
+                cache = _get_sky_cache(datai, self.ra_name, self.dec_name, fingerprint)
+                if cache is None:
+                    # check missing values for ra and dec
+                    # TODO: below NOT TESTED
+                    if np.ma.is_masked(ra) or np.ma.is_masked(dec): # datai.t.masked or 
+                        missingi = np.full(len(datai), False)
+                        if np.ma.is_masked(ra):
+                            missingi |= ra.mask
+                        if np.ma.is_masked(dec):
+                            missingi |= dec.mask
+                        not_missing_idi = np.flatnonzero(~missingi)
+                    else:
+                        missingi, not_missing_idi = None, None
+                    
+                    # keep plain float64 arrays in rad (no SkyCoord); the column units are used if given
+                    rads = []
+                    for which_coor, col, unit_coor in zip([self.ra_name, self.dec_name], [ra, dec], units):
+                        try:
+                            rads.append(_col_to_rad(col, unit_coor, missingi))
+                        except UnitTypeError as e:
+                            raise UnitTypeError(f"Unrecognized unit for column '{which_coor}': {e.args[0]}."\
+                                                f" Try manually setting {datai.__repr__()}.t['{which_coor}'].unit") from e
+                    ra_rad, dec_rad = rads
                     
-                not_missing_idi = np.arange(len(datai), dtype=int)[~missingi]
+                    cache = _set_sky_cache(datai, self.ra_name, self.dec_name, fingerprint, objdict(
+                        missing = missingi,
+                        not_missing_id = not_missing_idi,
+                        ra_rad = ra_rad,
+                        dec_rad = dec_rad,
+                        xyz = _radec_to_xyz(ra_rad, dec_rad), # Cartesian coordinates on the unit sphere, used for the KD-tree
+                        has_dup = _has_dup_coord(ra_rad, dec_rad),
+                        ))
                 
-                try:
-                    coordi = SkyCoord(ra=ra[~missingi], dec=dec[~missingi], unit=uniti)
-                except UnitTypeError as e:
-                    info = e.args[0]
-                    which_coor = self.ra_name if 'Longitude' in info else self.dec_name
-                    got_unit =  info.split('set it to ')[-1]
-                    raise UnitTypeError(f"Unrecognized unit for column '{which_coor}': expected units equivalent to 'rad', got {got_unit}"\
-                                        f" Try manually setting {datai.__repr__()}.t['{which_coor}'].unit") from e
+                missingi, not_missing_idi = cache.missing, cache.not_missing_id
+                ra_rad, dec_rad = cache.ra_rad, cache.dec_rad
+                xyzi, has_dupi = cache.xyz, cache.has_dup
             
-            elif type(coordi) is SkyCoord:
+            else: # source == 'skycoord'
                 self.ra_name, self.dec_name = None, None
-                coordi = coordi
+                # columns are interpreted in ICRS (the default frame of SkyCoord); convert to the same frame
+                icrs = coordi.icrs
+                ra_rad = np.ascontiguousarray(icrs.ra.rad, dtype=np.float64)
+                dec_rad = np.ascontiguousarray(icrs.dec.rad, dtype=np.float64)
                 
-                missingi = np.full(len(datai), False)
-                not_missing_idi = np.arange(len(datai), dtype=int)[~missingi]
-            
-            else:
-                raise TypeError(f"Unsupported type for coord/coord1: expected str or astropy.coordinates.SkyCoord, got {type(coordi)}")
+                missingi, not_missing_idi = None, None
                 
-            coords.append(coordi)
+                xyzi = _radec_to_xyz(ra_rad, dec_rad)
+                has_dupi = _has_dup_coord(ra_rad, dec_rad)
+                
+            radecs.append((ra_rad, dec_rad))
+            xyzs.append(xyzi)
+            has_dups.append(has_dupi)
             missings.append(missingi)
             not_missing_ids.append(not_missing_idi)
         
-        self.coord, self.coord1 = coords
+        (self.ra_rad, self.dec_rad), (self.ra_rad1, self.dec_rad1) = radecs
         self.missing, self.missing1 = missings
         self.not_missing_id, self.not_missing_id1 = not_missing_ids
         
+        self._xyz, self._xyz1 = xyzs
+        
+        # the threshold as plain floats, so that no Quantity is needed for the comparison;
+        # the chord distance is compared directly (equivalent to comparing angular separations)
+        self._thres_rad = self.thres / _RAD_TO_ARCSEC
+        self._chord_thres = 2*np.sin(0.5*self._thres_rad)
+        
         # check duplicates for coordinates
-        _, counts = np.unique(np.stack([self.coord.ra, self.coord.dec]), axis=1, return_counts=True)
-        if np.any(counts != 1):
+        if has_dups[0]:
             warnings.warn(f"Duplications found for data '{data.name}' while matching '{data1.name}' to it: the same row of '{data1.name}' may be matched to multiple rows in '{data.name}'.",
                           stacklevel=3, category=DuplicationWarning)
-        _, counts = np.unique(np.stack([self.coord1.ra, self.coord1.dec]), axis=1, return_counts=True)
-        if np.any(counts != 1):
+        if has_dups[1]:
             warnings.warn(f"Duplications found for data '{data1.name}' while matching to '{data.name}': there may be multiple rows in '{data1.name}' that can be matched to a row in '{data.name}', and only one will be returned by the matcher.",
                           stacklevel=3, category=DuplicationWarning)
         
+    def _query_nearest(self, distance_upper_bound=np.inf):
+        # returns the distance (the chord distance for 'kdtree', the angular distance in rad for 'balltree') 
+        # and the index of the nearest neighbor.
+        # for 'kdtree', neighbors farther than distance_upper_bound (chord distance) are not searched for (d = inf)
+        if self.tree == 'balltree':
+            from sklearn.neighbors import BallTree
+            tree = BallTree(np.column_stack([self.dec_rad1, self.ra_rad1]), metric='haversine')
+            d, idx_nm = tree.query(np.column_stack([self.dec_rad, self.ra_rad]), k=1)
+            return d[:, 0], idx_nm[:, 0]
+        
+        # the chord distance on the unit sphere is monotonic in the angular distance,
+        # so the nearest neighbor in 3-d is also the nearest on the sky
+        # the query is done in chunks for cache locality, each parallelized on all cores (workers=-1)
+        tree = cKDTree(self._xyz1)
+        n = self._xyz.shape[0]
+        d_chord, idx_nm = np.empty(n, dtype=np.float64), np.empty(n, dtype=np.intp)
+        for start in range(0, n, _QUERY_CHUNK_SIZE):
+            chunk = slice(start, start + _QUERY_CHUNK_SIZE)
+            d_chord[chunk], idx_nm[chunk] = tree.query(self._xyz[chunk], k=1, distance_upper_bound=distance_upper_bound, workers=-1)
+        return d_chord, idx_nm
+    
+    def _query_within(self):
+        if self.tree == 'balltree':
+            d, idx_nm = self._query_nearest()
+            return idx_nm, d < self._thres_rad
+        
+        # nearest neighbor query bounded by the threshold, so that the search is pruned early;
+        # rows without a neighbor within the threshold get d = inf (and an out-of-range index)
+        d_chord, idx_nm = self._query_nearest(distance_upper_bound=self._chord_thres)
+        found = d_chord < self._chord_thres
+        return np.where(found, idx_nm, 0), found
+    
     def match(self):
-        l = len(self.missing)
-        idx = np.full(self.missing.shape, -l-1)
-        matched = np.full(self.missing.shape, False)
-        idx_nm, d2d, d3d = self.coord.match_to_catalog_sky(self.coord1)
-        idx[~self.missing] = self.not_missing_id1[idx_nm]
-        matched[~self.missing] = d2d.arcsec < self.thres
-        return idx, matched
+        idx_nm, found = self._query_within()
+        return _fill_match(idx_nm, found, self.missing, self.not_missing_id1)
     
     def explore(self, data, data1):
         '''
@@ -261,23 +625,30 @@ class SkyMatcher():
 
         Returns
         -------
-        None.
+        d2d : np.ndarray
+            The minimum sky separation (in arcsec) for each row of ``data``
+            with non-missing coordinates.
 
         '''
         self.get_values(data, data1)
-        idx, d2d, d3d = self.coord.match_to_catalog_sky(self.coord1)
+        d, idx_nm = self._query_nearest()
+        # the separation (in arcsec) to the nearest neighbor, computed with the haversine formula
+        d2d = _sep_arcsec(self.ra_rad, self.dec_rad, self.ra_rad1, self.dec_rad1, idx_nm)
+        # the tree distances are no longer needed; reuse them as the buffer for lg(d2d)
+        lgd = np.log10(d2d, out=d)
         import matplotlib.pyplot as plt
         plt.figure()
-        plt.hist(np.log10(d2d.arcsec), bins=min((200, len(data)//20)), histtype='step', linewidth=1.5, log=True)
+        plt.hist(lgd, bins=min((200, len(data)//20)), histtype='step', linewidth=1.5, log=True)
         plt.axvline(np.log10(self.thres), color='r', linestyle='--')
         plt.xlabel('lg (d / arcsec)')
         plt.title(f"Min. distance to '{data1.name}' objects for each '{data.name}' object\nthreshold={self.thres}\"")
-        return d2d.arcsec
+        return d2d
         
     def __repr__(self):
         # TODO: show more information here 
         return f'<SkyMatcher with thres={self.thres}>'
 
+
 class IdentityMatcher():
     def __init__(self):
         '''
@@ -294,7 +665,7 @@ class IdentityMatcher():
         self.len = len(data)
     
     def match(self):
-        idx = np.arange(self.len)
+        idx = np.arange(self.len, dtype=np.intp)
         matched = np.full((self.len,), True)
         return idx, matched    
     
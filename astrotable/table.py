@@ -11,7 +11,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 from astropy.table import Column, Table, hstack
 # from astropy.io import ascii as apascii
-from astrotable.utils import objdict, save_pickle, load_pickle, keyword_alias, bitwise_all, pause_and_warn, find_dup
+from astrotable.utils import objdict, save_pickle, load_pickle, keyword_alias, bitwise_all, pause_and_warn, find_dup, SENTINEL
 import astrotable.plot as plot
 import astrotable
 import warnings
@@ -619,6 +619,10 @@ Set 'replace=True' to replace the existing match with '{data1.name}'.")
         
         matcher.get_values(self, data1, verbose=verbose)
         idx, matched = matcher.match()
+        idx, matched = np.asarray(idx), np.asarray(matched, dtype=bool)
+        if idx.dtype.kind not in 'iu':
+            raise TypeError(f"expected integer 'idx' returned by {type(matcher).__name__}.match(), got dtype {idx.dtype}")
+        idx = idx.astype(np.intp, copy=False) # custom matchers may return e.g. int32; SENTINEL needs intp
         info = objdict(
             matcher = matcher,
             data1 = data1,
@@ -727,7 +731,7 @@ Set 'replace=True' to replace the existing match with '{data1.name}'.")
                     continue
                 
                 # get match info for data1  (self's parent to self's child "data1")
-                idx_s = info.idx # _s: self - child match
+                idx_s = np.asarray(info.idx, dtype=np.intp) # _s: self - child match
                 matched_s = info.matched
                 
                 idx_temp = idx.copy()
@@ -736,7 +740,7 @@ Set 'replace=True' to replace the existing match with '{data1.name}'.")
                 idx_ps = idx_s[idx_temp] # _ps: parent - child match
                 matched_ps = matched_s[idx_temp]
                 matched_ps &= matched
-                idx_ps[~matched_ps] = -len(data1) - 1
+                idx_ps[~matched_ps] = SENTINEL
                 
                 data1s.append(data1)
                 # ignore_id.append(id(data1)) # this is done in data1._match_propagate
@@ -13,12 +13,14 @@ from functools import wraps, reduce
 from operator import iand, ior
 
 #%% array/Iterable operation
+SENTINEL = np.iinfo(np.intp).min # the index given to values/rows that are not found/matched
+
 
 def find_idx(array, values):
     '''
     Find the indexes of values in array.
     
-    If not found, will return -l-1, which is out of
+    If not found, will return ``SENTINEL``, which is out of
     the range of array.
 
     Parameters
@@ -43,7 +45,7 @@ def find_idx(array, values):
     found = ~not_found
     ss[not_found] = -1
     idx = sorter[ss]
-    idx[not_found] = -l-1
+    idx[not_found] = SENTINEL
     return idx, found
 
 def find_eq(array, values):